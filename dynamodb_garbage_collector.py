@@ -1,195 +1,399 @@
 import boto3
 import botocore
 import datetime
+import hashlib
+import math
+import os
+import random
 import time
-from typing import List, Dict, Any, Type
-from concurrent.futures import ThreadPoolExecutor, Future
-from threading import Lock
+from typing import Iterator, List, Tuple, Type
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event, Lock, Thread
 from logging import Logger
+from operator import itemgetter
 
-def _delete_items(client: Type[boto3.client], table: str, 
-                  items: List[Dict[str, Any]]) -> int:
-    # Create a list of delete requests for each item
-    unprocessed_items = [{'DeleteRequest':{'Key': item}} for item in items]
+# Maximum attempts and backoff time in seconds for retrying delete operations
+_MAX_ATTEMPTS = 8
+_MAX_BACKOFF = 32
 
-    # Backoff time for retrying requests that fail due to exceeded throughput
+# Maximum child items of a scan segment kept pending while the parent scan is running
+_MAX_PENDING_CHILD_ITEMS = 10000
+
+# Names of the client exceptions of the batch write request retried by _delete_items
+_RETRYABLE_EXCEPTION_NAMES = (
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+    'InternalServerError'
+)
+
+# Minimum time in seconds between logs of the total scanned and deleted items
+_LOG_INTERVAL = 1.0
+
+# False positive rate of the Bloom filter of parent ids
+_BLOOM_ERROR_RATE = 0.01
+
+class _BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        # Number of bits and hash functions giving the error rate for the capacity
+        self._size = max(1, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+
+        # Random salt of the hash, so the false positives differ between executions
+        self._salt = os.urandom(16)
+
+    def _positions(self, value: str) -> Iterator[int]:
+        # Derive the bit positions of all hash functions from two halves of a 
+        # single digest (double hashing)
+        digest = hashlib.blake2b(value.encode(), digest_size=16, salt=self._salt).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) 
+                   for position in self._positions(value))
+
+def _delete_items(client: Type[boto3.client], table: str, key_attribute: str,
+                  keys: List[str],
+                  retryable_exceptions: Tuple[Type[Exception], ...]) -> int:
+    # Create a list of delete requests for each string key of the items
+    unprocessed_items = [{'DeleteRequest': {'Key': {key_attribute: {'S': key}}}} for key in keys]
+
+    # Backoff time for retrying unprocessed items or requests that fail due to 
+    # exceeded throughput or transient errors
     backoff = 1
 
-    while unprocessed_items: 
-        response = None
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            # Sleep with a jitter, so concurrent delete operations don't retry at the 
+            # same time, and retry with an increased backoff time up to _MAX_BACKOFF
+            time.sleep(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, _MAX_BACKOFF)
+
         try:
             # Perform the batch write request
             response = client.batch_write_item(
                 RequestItems={
                     table: unprocessed_items
                 })
-        except client.exceptions.ProvisionedThroughputExceededException:
-            # If the request fails due to exceeded throughput, sleep and
-            # retry with an increased backoff time            
-            time.sleep(backoff)
-            backoff *= 2
+        except retryable_exceptions:
+            # Throttled requests and transient errors are already retried by the client 
+            # in adaptive retry mode, so this is only reached when its retry attempts 
+            # are exhausted
+            # Raise the exception if it happens in the last attempt
+            if attempt == _MAX_ATTEMPTS:
+                raise
         else:
-            # Reset the backoff time if the request succeeded
-            backoff = 1
-
-        # Check if there are any unprocessed items and retry them in the 
-        # next iteration if there are
-        if response:
+            # Finish if there are no unprocessed items, otherwise retry them
             unprocessed_items = response.get('UnprocessedItems', {}).get(table, [])
+            if not unprocessed_items:
+                return len(keys)
 
-    return len(items)
+    raise RuntimeError(f'{len(unprocessed_items)} items in {table} still unprocessed '
+                       f'after {_MAX_ATTEMPTS} batch write attempts')
 
 def purge_orphan_items(logger: Logger, region: str, parent_table: str, child_table: str, 
                        key_attribute: str, child_reference_attribute: str, 
                        max_workers: int = 100, timestamp_attribute: str = None, 
-                       timestamp_format: str = None) -> None:
+                       timestamp_format: str = None, scan_segments: int = 8, 
+                       use_bloom: bool = False) -> None:
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than 0')
+    if scan_segments < 1:
+        raise ValueError('scan_segments must be greater than 0')
+
     logger.info(f'Purge of orphaned items in {child_table} referencing a '
                 f'non-existent item in {parent_table} started')
     
     # Initialize DynamoDB client with specified AWS region and 
-    # max_pool_connections that is slightly larger than max_workers
+    # max_pool_connections that is slightly larger than max_workers plus the scan 
+    # segments of both tables, so scan and delete operations don't wait for a connection
+    # TCP keep-alive is enabled so pooled connections are reused instead of paying 
+    # a new TCP and TLS handshake, and adaptive retry mode is used to retry 
+    # throttled requests with client side rate limiting
     client = boto3.client(
         "dynamodb", 
         region_name=region, 
-        config=botocore.config.Config(max_pool_connections=max_workers+10))
+        config=botocore.config.Config(
+            max_pool_connections=max_workers+2*scan_segments+10,
+            tcp_keepalive=True,
+            retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+    # Exceptions of the batch write request that are retried by _delete_items, resolved 
+    # once from the client instead of on every delete operation
+    # ThrottlingException is only modeled by recent botocore versions, so exceptions 
+    # missing in the installed version are skipped
+    retryable_exceptions = tuple(
+        getattr(client.exceptions, exception_name)
+        for exception_name in _RETRYABLE_EXCEPTION_NAMES
+        if hasattr(client.exceptions, exception_name))
 
     # Initialize variables used to track deleted items and execute deletion operations 
     # concurrently
+    # Batches of item keys are put by the scan segments in delete_queue and 
+    # deleted by max_workers worker threads, with the queue bounded so scan segments 
+    # block on put while the workers catch up
     deleted_items_counter = 0
-    last_logged_counter = 0
+    last_deleted_log_time = time.monotonic()
     lock = Lock()  
-    executor = ThreadPoolExecutor(max_workers=max_workers)
-
-    # Closure of purge_orphan_items used to submit a delete items operation
-    def submit_delete_items(table: str, items: List):        
-        # Callback called when a delete items operation completes 
-        # Lock used to ensure variables deleted_items_counter and last_logged_counter 
-        # of purge_orphan_items are updated atomically        
-        def delete_items_callback(future: Future):
-            nonlocal deleted_items_counter
-            nonlocal last_logged_counter
+    delete_queue = Queue(maxsize=max_workers*2)
+
+    # Closure of purge_orphan_items run by the delete worker threads, deleting the 
+    # batches of delete_queue until receiving None
+    # Lock used to ensure variables deleted_items_counter and last_deleted_log_time 
+    # of purge_orphan_items are updated atomically, logging the total at most once 
+    # every _LOG_INTERVAL seconds outside of the lock
+    def delete_items_worker():
+        nonlocal deleted_items_counter
+        nonlocal last_deleted_log_time
+        while True:
+            keys = delete_queue.get()
+            if keys is None:
+                break
+            try:
+                deleted_items = _delete_items(
+                    client=client,
+                    table=child_table,
+                    key_attribute=key_attribute,
+                    keys=keys,
+                    retryable_exceptions=retryable_exceptions)
+            except Exception:
+                logger.exception(f'Delete of {len(keys)} items in {child_table} failed')
+                continue
+            counter_to_log = None
             with lock:
-                deleted_items_counter += future.result()
-                if deleted_items_counter - last_logged_counter >= 100:
-                    logger.info(f'Total deleted items in {table}: {deleted_items_counter}')
-                    last_logged_counter = deleted_items_counter
-                    
-        # Wait until the size of the work queue of the executor is less than 10
-        while executor._work_queue.qsize() >= 10:
-            pass
-        future = executor.submit(
-            _delete_items, 
-            client=client,
-            table=table,
-            items=items)
-        future.add_done_callback(delete_items_callback)    
-
-    # Query the parent table to get all parent ids
-    parent_table_ids = []
-    query_response = client.scan(
-        TableName=parent_table, 
-        ProjectionExpression=f'#{key_attribute}',
-        ExpressionAttributeNames={
-            f'#{key_attribute}': key_attribute
-        })
+                deleted_items_counter += deleted_items
+                now = time.monotonic()
+                if now - last_deleted_log_time >= _LOG_INTERVAL:
+                    counter_to_log = deleted_items_counter
+                    last_deleted_log_time = now
+            if counter_to_log is not None:
+                logger.info(f'Total deleted items in {child_table}: {counter_to_log}')
 
+    # Delete worker threads, started once all setup is done so they are always 
+    # stopped by the sentinels of the scan finally block
+    delete_workers = []
+
+    # Separate executor for the parallel scan segments of both tables, so scan 
+    # operations don't compete with delete operations for the delete workers
+    scan_executor = ThreadPoolExecutor(max_workers=2*scan_segments)
+
+    # Item getters of the key and reference attributes bound once, as they are 
+    # called for every scanned item
+    get_key = itemgetter(key_attribute)
+    get_reference = itemgetter(child_reference_attribute)
+
+    # Initialize variables used to track scanned items of both tables from the 
+    # concurrent scan segments
     scanned_parent_items = 0
+    scanned_child_items = 0
+    last_parent_log_time = last_child_log_time = time.monotonic()
+    scan_lock = Lock()
+
+    # Closure of purge_orphan_items used to add the number of items of a scanned page 
+    # to the counter of the parent or child table, logging the total at most once every 
+    # _LOG_INTERVAL seconds outside of the lock
+    # An explicit flag selects the counter, as both tables may be the same table
+    def count_scanned_items(parent: bool, page_items: int):
+        nonlocal scanned_parent_items
+        nonlocal scanned_child_items
+        nonlocal last_parent_log_time
+        nonlocal last_child_log_time
+        counter_to_log = None
+        with scan_lock:
+            now = time.monotonic()
+            if parent:
+                scanned_parent_items += page_items
+                if now - last_parent_log_time >= _LOG_INTERVAL:
+                    counter_to_log = scanned_parent_items
+                    last_parent_log_time = now
+            else:
+                scanned_child_items += page_items
+                if now - last_child_log_time >= _LOG_INTERVAL:
+                    counter_to_log = scanned_child_items
+                    last_child_log_time = now
+        if counter_to_log is not None:
+            table = parent_table if parent else child_table
+            logger.info(f'Total scanned items in {table}: {counter_to_log}')
 
-    # Process all pages returned by the scan
-    while 'LastEvaluatedKey' in query_response:
-        for item in query_response['Items']:
-            parent_table_ids.append(item[key_attribute]['S'])
-            scanned_parent_items += 1
-            if scanned_parent_items % 1000 == 0:
-                logger.info(f'Total scanned items in {parent_table}: {scanned_parent_items}')
-        query_response = client.scan(TableName=parent_table, 
-                                     ProjectionExpression=f'#{key_attribute}',
-                                     ExpressionAttributeNames={
-                                         f'#{key_attribute}': key_attribute
-                                     },
-                                     ExclusiveStartKey=query_response['LastEvaluatedKey'])
-
-    # Process the final page of results
-    for item in query_response['Items']:
-        parent_table_ids.append(item[key_attribute]['S'])
-        scanned_parent_items += 1        
-
-    logger.info(f'Total scanned items in {parent_table}: {scanned_parent_items}')
-
-    # Set the maximum timestamp for the records to delete (e.g., one hour ago)
-    # This will be used only if the timestamp condition should be applied
-    max_timestamp = datetime.datetime.utcnow() - datetime.timedelta(hours=1)                
+    # Paginator handling the last evaluated key of the scan operations, so the items 
+    # of every page, including the final one, are processed by a single loop
+    scan_paginator = client.get_paginator('scan')
+
+    # Scan arguments of the parent table, selecting only the key attribute
+    parent_scan_kwargs = {
+        'TableName': parent_table,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ProjectionExpression': f'#{key_attribute}',
+        'ExpressionAttributeNames': {
+            f'#{key_attribute}': key_attribute
+        }
+    }
+
+    # Container of all parent ids, a set or, if use_bloom is enabled, a Bloom filter 
+    # sized with the approximate item count of the parent table
+    # A Bloom filter may report an id as present when it is not, which only causes 
+    # some orphan items to be kept, never an item with an existing parent to be deleted
+    if use_bloom:
+        parent_item_count = client.describe_table(TableName=parent_table)['Table']['ItemCount']
+        parent_table_ids = _BloomFilter(capacity=max(parent_item_count, 1000),
+                                        error_rate=_BLOOM_ERROR_RATE)
+    else:
+        parent_table_ids = set()
+
+    # Lock used to ensure parent ids of the concurrent scan segments are added to 
+    # parent_table_ids atomically
+    parent_ids_lock = Lock()
+
+    # Closure of purge_orphan_items used to scan one segment of the parent table 
+    # and add the parent ids found in it to parent_table_ids
+    def scan_parent_segment(segment: int) -> None:
+        add_parent_id = parent_table_ids.add
+        for page in scan_paginator.paginate(
+                **parent_scan_kwargs,
+                Segment=segment,
+                TotalSegments=scan_segments):
+            with parent_ids_lock:
+                for item in page['Items']:
+                    add_parent_id(get_key(item)['S'])
+            count_scanned_items(True, page['ScannedCount'])
 
     # Iterate through the child table and delete records whose child_reference_attribute
-    # is not in the parent_table_ids list and, if optional timestamp attributes are provided, 
+    # is not in parent_table_ids and, if optional timestamp attributes are provided, 
     # whose timestamp attribute is earlier than the specified maximum time    
-    expression_attribute_names = {
-        f'#{key_attribute}': key_attribute,
-        f'#{child_reference_attribute}': child_reference_attribute 
+    child_scan_kwargs = {
+        'TableName': child_table,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ProjectionExpression': f'#{key_attribute}, #{child_reference_attribute}',
+        'ExpressionAttributeNames': {
+            f'#{key_attribute}': key_attribute,
+            f'#{child_reference_attribute}': child_reference_attribute 
+        }
     }
-    projection_expression = f'#{key_attribute}, #{child_reference_attribute}'
     if timestamp_attribute is not None and timestamp_format is not None:
-        expression_attribute_names[f'#{timestamp_attribute}'] = timestamp_attribute
-        projection_expression = f'#{key_attribute}, #{child_reference_attribute}, #{timestamp_attribute}'
-
-    response = client.scan(
-        TableName=child_table, 
-        ProjectionExpression=projection_expression,
-        ExpressionAttributeNames=expression_attribute_names
-    )
-    scanned_child_items = 0
-    unprocessed_orphan_items = []
-    while 'LastEvaluatedKey' in response:
-        for item in response['Items']:
-            scanned_child_items += 1
-            if scanned_child_items % 1000 == 0:
-                logger.info(f'Total scanned items in {child_table}: {scanned_child_items}')
-
-            if timestamp_attribute is not None and timestamp_format is not None:
-                # Check if the item's timestamp attribute is after the maximum timestamp 
-                # If it is, skip the item and continue to the next one
-                if item[timestamp_attribute]['S'] > max_timestamp.strftime(timestamp_format):
-                    continue
-
-            if item[child_reference_attribute]['S'] not in parent_table_ids:
-                unprocessed_orphan_items.append({key_attribute: item[key_attribute]})
-                # Begins delete operation when accumulated items in unprocessed_orphan_items reaches 25
-                if len(unprocessed_orphan_items) == 25:
-                    submit_delete_items(child_table, unprocessed_orphan_items)
-                    unprocessed_orphan_items = []            
-
-        response = client.scan(
-            TableName=child_table,
-            ProjectionExpression=projection_expression,
-            ExpressionAttributeNames=expression_attribute_names,
-            ExclusiveStartKey=response['LastEvaluatedKey'])      
-
-    # Delete remaining items in the final page of the scan
-    for item in response['Items']:
-        scanned_child_items += 1
-
-        if timestamp_attribute is not None and timestamp_format is not None:
-            # Check if the item's timestamp attribute is after the maximum timestamp 
-            # If it is, skip the item and continue to the next one
-            if item[timestamp_attribute]['S'] > max_timestamp.strftime(timestamp_format):
-                continue
+        # Set the maximum timestamp for the records to delete (e.g., one hour ago), 
+        # formatted once with timestamp_format to be compared with the timestamp 
+        # attribute of the child items
+        max_timestamp = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+        max_timestamp_str = max_timestamp.strftime(timestamp_format)
 
-        if item[child_reference_attribute]['S'] not in parent_table_ids:
-            unprocessed_orphan_items.append({key_attribute: item[key_attribute]})
-            # Begins delete operation when accumulated items in unprocessed_orphan_items reaches 25
-            if len(unprocessed_orphan_items) == 25:
-                submit_delete_items(child_table, unprocessed_orphan_items)
-                unprocessed_orphan_items = []   
+        # Filter out items whose timestamp attribute is after the maximum timestamp in 
+        # DynamoDB, so they are not returned by the scan
+        child_scan_kwargs['ExpressionAttributeNames'][f'#{timestamp_attribute}'] = timestamp_attribute
+        child_scan_kwargs['FilterExpression'] = f'#{timestamp_attribute} <= :max_timestamp'
+        child_scan_kwargs['ExpressionAttributeValues'] = {
+            ':max_timestamp': {'S': max_timestamp_str}
+        }
 
-    # If there are remaining items in unprocessed_orphan_items proceed with delete operation
-    if len(unprocessed_orphan_items) > 0:
-        submit_delete_items(child_table, unprocessed_orphan_items)
+    # Events used to signal the child scan segments that the parent scan finished 
+    # and whether it succeeded, so parent_table_ids contains all parent ids
+    parent_scan_finished = Event()
+    parent_table_scanned = Event()
+
+    # Closure of purge_orphan_items used to scan one segment of the child table 
+    # and put the batches of keys of the orphan items found in it in delete_queue
+    # While the parent scan is running, the reference and key of child items whose 
+    # reference is not yet in parent_table_ids are kept pending and checked again once 
+    # it finishes, waiting for it once _MAX_PENDING_CHILD_ITEMS are pending
+    def scan_child_segment(segment: int) -> None:
+        parent_table_ids_contains = parent_table_ids.__contains__
         unprocessed_orphan_items = []
+        pending_child_items = []
+
+        # Closure of scan_child_segment used to accumulate the key of an orphan item
+        # Puts the batch in delete_queue when accumulated items in unprocessed_orphan_items reaches 25
+        def add_orphan_item(key: str):
+            nonlocal unprocessed_orphan_items
+            unprocessed_orphan_items.append(key)
+            if len(unprocessed_orphan_items) == 25:
+                delete_queue.put(unprocessed_orphan_items)
+                unprocessed_orphan_items = []
+
+        # Closure of scan_child_segment used to wait until the parent scan finishes 
+        # and check the pending child items, returning whether the parent scan succeeded
+        def check_pending_child_items() -> bool:
+            parent_scan_finished.wait()
+            if not parent_table_scanned.is_set():
+                return False
+            for reference, key in pending_child_items:
+                if not parent_table_ids_contains(reference):
+                    add_orphan_item(key)
+            pending_child_items.clear()
+            return True
+
+        for page in scan_paginator.paginate(
+                **child_scan_kwargs,
+                Segment=segment,
+                TotalSegments=scan_segments):
+            # Stop if the parent scan failed, as orphan items can't be determined
+            if parent_scan_finished.is_set() and not parent_table_scanned.is_set():
+                return
+            parent_ids_complete = parent_table_scanned.is_set()
+            for item in page['Items']:
+                reference = get_reference(item)['S']
+                if not parent_table_ids_contains(reference):
+                    if parent_ids_complete:
+                        add_orphan_item(get_key(item)['S'])
+                    else:
+                        pending_child_items.append((reference, get_key(item)['S']))
+            count_scanned_items(False, page['ScannedCount'])
+
+            # Bound the memory of the pending child items by waiting for the parent scan
+            if len(pending_child_items) >= _MAX_PENDING_CHILD_ITEMS:
+                if not check_pending_child_items():
+                    return
+
+        if not check_pending_child_items():
+            return
+
+        # If there are remaining items in unprocessed_orphan_items put them in delete_queue
+        if len(unprocessed_orphan_items) > 0:
+            delete_queue.put(unprocessed_orphan_items)
+            unprocessed_orphan_items = []
+
+    try:
+        for _ in range(max_workers):
+            worker = Thread(target=delete_items_worker)
+            worker.start()
+            delete_workers.append(worker)
+
+        # Scan the parent and child tables concurrently, each in parallel segments
+        parent_futures = [scan_executor.submit(scan_parent_segment, segment) 
+                          for segment in range(scan_segments)]
+        child_futures = [scan_executor.submit(scan_child_segment, segment) 
+                         for segment in range(scan_segments)]
+
+        # Wait for the parent scan segments, raising any exception of them, and signal 
+        # the child scan segments when the parent scan finishes
+        try:
+            for future in parent_futures:
+                future.result()
+            parent_table_scanned.set()
+        finally:
+            parent_scan_finished.set()
+
+        logger.info(f'Total scanned items in {parent_table}: {scanned_parent_items}')
 
-    logger.info(f'Total scanned items in {child_table}: {scanned_child_items}')         
+        # Wait for the child scan segments, raising any exception of them
+        for future in child_futures:
+            future.result()
 
-    # Shutdown the executor and wait for all tasks to complete
-    executor.shutdown(wait=True)
+        logger.info(f'Total scanned items in {child_table}: {scanned_child_items}')         
+    finally:
+        # Shutdown the scan executor, stop the delete workers and wait for all 
+        # queued batches to be deleted
+        scan_executor.shutdown(wait=True)
+        for _ in delete_workers:
+            delete_queue.put(None)
+        for worker in delete_workers:
+            worker.join()
 
     logger.info(f'Purge of orphaned items in {child_table} referencing a '
                 f'non-existent item in {parent_table} finished with total '